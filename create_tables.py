@@ -4,7 +4,8 @@ import psycopg2
 from psycopg2.extensions import connection, cursor
 
 from db_values import HOST, DBNAME, USER, PASSWORD
-from sql_queries import CREATE_TABLE_QUERIES, DROP_TABLE_QUERIES
+from sql_queries import (CREATE_TABLE_QUERIES, DROP_TABLE_QUERIES,
+                         CREATE_INDEX_QUERIES)
 
 
 def create_database(host: str = HOST,
@@ -58,7 +59,7 @@ def create_database(host: str = HOST,
 
 def execute_queries(cur: cursor, queries: List[str]) -> None:
     """
-    Execute list of queries in database.
+    Execute list of queries in database, in a single round-trip.
 
     Parameters
     ----------
@@ -71,8 +72,8 @@ def execute_queries(cur: cursor, queries: List[str]) -> None:
     -------
     None
     """
-    for query in queries:
-        cur.execute(query)
+    script = ';\n'.join(query.strip().rstrip(';') for query in queries)
+    cur.execute(script)
 
 
 def main():
@@ -80,6 +81,7 @@ def main():
 
     execute_queries(cur, queries=DROP_TABLE_QUERIES)
     execute_queries(cur, queries=CREATE_TABLE_QUERIES)
+    execute_queries(cur, queries=CREATE_INDEX_QUERIES)
     print('All tables were successfully created!')
 
     conn.close()
@@ -1,62 +1,240 @@
-import glob
+import io
 import os
-from typing import List
+import struct
+from multiprocessing import Pool
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+import orjson
 import pandas as pd
 import psycopg2
-from numpy import int64
 from psycopg2.extensions import connection, cursor
+from psycopg2.extras import execute_values
 
+from create_tables import execute_queries
 from db_values import HOST, DBNAME, USER, PASSWORD
-from sql_queries import (SONG_TABLE_INSERT, ARTIST_TABLE_INSERT,
-                         TIME_TABLE_INSERT, USER_TABLE_INSERT, SONG_SELECT,
-                         SONGPLAY_TABLE_INSERT)
+from sql_queries import (BEFORE_LOAD_QUERIES, AFTER_LOAD_QUERIES,
+                         SONG_TABLE_INSERT_MANY, ARTIST_TABLE_INSERT_MANY,
+                         TIME_TABLE_INSERT_MANY,
+                         USER_TABLE_INSERT_MANY,
+                         SONG_SELECT_MANY, SONG_SELECT_MANY_TEMPLATE,
+                         SONGPLAY_TABLE_COPY)
 
-# To avoid `psycopg2.ProgrammingError: can't adapt type 'numpy.int64'` when
-# executing the INSERT command:
-psycopg2.extensions.register_adapter(int64, psycopg2._psycopg.AsIs)
+# Number of rows sent in each statement by `execute_values`
+PAGE_SIZE = 1000
 
+# (song_id, artist_id) by (song title, artist name, song duration), shared by
+# all log files; the songs and artists tables do not change during the log
+# stage (the cache is cleared by `main` before it). Songs that are not in the
+# database map to (None, None).
+_song_cache: Dict[Tuple[str, str, float],
+                  Tuple[Optional[str], Optional[str]]] = {}
 
-def process_song_file(cur: cursor,
+# PostgreSQL binary COPY format: file header, file trailer and NULL field
+# (https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4)
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+PGCOPY_NULL = struct.pack('>i', -1)
+
+# PostgreSQL timestamps are microseconds since 2000-01-01 00:00:00 UTC
+PG_EPOCH_US = 946_684_800_000_000
+
+_int4 = struct.Struct('>ii')
+_int8 = struct.Struct('>iq')
+_length = struct.Struct('>i')
+
+
+def _encode_text(value) -> bytes:
+    data = value.encode('utf-8')
+    return _length.pack(len(data)) + data
+
+
+# Encoders from Python values to binary COPY fields (length + data), by type.
+# "timestamptz" takes nanoseconds since the Unix epoch (UTC).
+PGCOPY_ENCODERS = {
+    'int4': lambda value: _int4.pack(4, int(value)),
+    'timestamptz': lambda value: _int8.pack(8, value // 1000 - PG_EPOCH_US),
+    'text': _encode_text,
+}
+
+
+def collect_song_file(filepath: str) -> Tuple[tuple, tuple]:
+    """
+    Read JSON file with the data of a song and its artist.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of the JSON file.
+
+    Returns
+    -------
+    tuple, tuple
+        Song record (song_id, title, artist_id, year, duration) and artist
+        record (artist_id, name, location, latitude, longitude).
+    """
+    # Read song file (a single JSON record)
+    with open(filepath, 'rb') as f:
+        song = orjson.loads(f.read())
+
+    # All fields will be used below, except "num_songs", which seems to be
+    # always equal to 1.
+
+    song_data = (song['song_id'], song['title'], song['artist_id'],
+                 song['year'], song['duration'])
+    artist_data = (song['artist_id'], song['artist_name'],
+                   song['artist_location'], song['artist_latitude'],
+                   song['artist_longitude'])
+
+    return song_data, artist_data
+
+
+def process_song_data(cur: cursor,
                       filepath: str,
-                      song_table_insert: str = SONG_TABLE_INSERT,
-                      artist_table_insert: str = ARTIST_TABLE_INSERT):
+                      processes: Optional[int] = None,
+                      chunksize: int = 32) -> None:
     """
-    Read JSON file and insert data into songs and artists dimensional tables.
+    Read all song files under `filepath` and insert their data into songs and
+    artists dimensional tables.
+
+    The files are read by a pool of processes, and the records of all files
+    are inserted at the end, with one multi-row INSERT per page of records.
 
     Parameters
     ----------
     cur : psycopg2.extensions.cursor
         Database cursor.
     filepath : str
-        Path of the JSON file.
-    song_table_insert : str, optional
-        INSERT statement.
-    artist_table_insert : str, optional
-        INSERT statement.
+        Path with files possibly under sub-folders.
+    processes : int, optional
+        Number of worker processes. Default: number of CPUs.
+    chunksize : int, optional
+        Number of files sent to a worker process at a time.
 
     Returns
     -------
     None
     """
-    # Read song file
-    df = pd.read_json(filepath, lines=True)
 
-    # All columns will be used below, except "num_songs", which seems to be
-    # always equal to 1.
+    # Get all files matching extension in directory
+    all_files = get_files(filepath)
 
-    # Insert song record
-    song_data = (df
-                 .loc[0, ['song_id', 'title', 'artist_id', 'year', 'duration']]
-                 .values.tolist())
-    cur.execute(song_table_insert, song_data)
+    # Get total number of files found
+    num_files = len(all_files)
+    print('{:,d} files found in "{}"'.format(num_files, filepath))
 
-    # Insert artist record
-    artist_data = (df
-                   .loc[0, ['artist_id', 'artist_name', 'artist_location',
-                            'artist_latitude', 'artist_longitude']]
-                   .values.tolist())
-    cur.execute(artist_table_insert, artist_data)
+    # Read files in parallel
+    with Pool(processes or os.cpu_count()) as pool:
+        records = pool.map(collect_song_file, all_files, chunksize=chunksize)
+    print('{:03d}/{:03d} files read'.format(num_files, num_files))
+
+    # Insert song and artist records
+    songs = [song_data for song_data, _ in records]
+    artists = [artist_data for _, artist_data in records]
+    execute_values(cur, SONG_TABLE_INSERT_MANY, songs, page_size=PAGE_SIZE)
+    execute_values(cur, ARTIST_TABLE_INSERT_MANY, artists,
+                   page_size=PAGE_SIZE)
+    print('{:,d} songs and {:,d} artists inserted'.format(len(songs),
+                                                           len(artists)))
+
+
+def copy_binary(cur: cursor,
+                rows: Iterable[tuple],
+                field_types: Sequence[str],
+                copy_query: str) -> None:
+    """
+    Stream rows to the database with a COPY ... FROM STDIN command, in binary
+    format.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        Database cursor.
+    rows : iterable[tuple]
+        Data to copy. The fields must be in the same order as in `copy_query`.
+        None values are copied as NULL.
+    field_types : sequence[str]
+        Type of each field, one of the keys of `PGCOPY_ENCODERS`.
+    copy_query : str
+        COPY statement reading binary data from STDIN.
+
+    Returns
+    -------
+    None
+    """
+    encoders = [PGCOPY_ENCODERS[field_type] for field_type in field_types]
+    row_header = struct.pack('>h', len(encoders))
+
+    buf = io.BytesIO()
+    buf.write(PGCOPY_HEADER)
+    for row in rows:
+        buf.write(row_header)
+        buf.write(b''.join(PGCOPY_NULL if value is None else encode(value)
+                           for value, encode in zip(row, encoders)))
+    buf.write(PGCOPY_TRAILER)
+    buf.seek(0)
+    cur.copy_expert(copy_query, buf)
+
+
+def get_song_ids(cur: cursor, df: pd.DataFrame
+                 ) -> Dict[Tuple[str, str, float],
+                           Tuple[Optional[str], Optional[str]]]:
+    """
+    Get song_id and artist_id of all songs in the log data.
+
+    Songs already looked up (in any log file) are taken from a cache, and the
+    other ones are looked up with one query.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        Database cursor.
+    df : pd.DataFrame
+        Log data, with columns "song", "artist" and "length".
+
+    Returns
+    -------
+    dict[tuple[str, str, float], tuple[str | None, str | None]]
+        Map from (song title, artist name, song duration) of the songs in `df`
+        to (song_id, artist_id). Songs not found in the database are mapped
+        to (None, None).
+    """
+    all_keys = list(df
+                    .loc[:, ['song', 'artist', 'length']]
+                    .drop_duplicates()
+                    .itertuples(index=False, name=None))
+    song_keys = [key for key in all_keys if key not in _song_cache]
+    if song_keys:
+        _lookup_song_ids(cur, song_keys)
+
+    return {key: _song_cache[key] for key in all_keys}
+
+
+def _lookup_song_ids(cur: cursor,
+                     song_keys: List[Tuple[str, str, float]]) -> None:
+    """
+    Look up song_id and artist_id of songs with one query, and add them to the
+    cache.
+
+    Parameters
+    ----------
+    cur : psycopg2.extensions.cursor
+        Database cursor.
+    song_keys : list[tuple[str, str, float]]
+        Distinct (song title, artist name, song duration) to look up.
+
+    Returns
+    -------
+    None
+    """
+    results = execute_values(cur, SONG_SELECT_MANY, song_keys,
+                             template=SONG_SELECT_MANY_TEMPLATE,
+                             page_size=len(song_keys), fetch=True)
+
+    song_ids = {}
+    for title, name, duration, song_id, artist_id in results:
+        song_ids.setdefault((title, name, duration), (song_id, artist_id))
+    for key in song_keys:
+        _song_cache[key] = song_ids.get(key, (None, None))
 
 
 def process_log_file(cur, filepath: str):
@@ -75,8 +253,10 @@ def process_log_file(cur, filepath: str):
     -------
     None
     """
-    # Open log file
-    df = pd.read_json(filepath, lines=True)
+    # Open log file (one JSON record per line)
+    with open(filepath, 'rb') as f:
+        df = pd.DataFrame.from_records([orjson.loads(line) for line in f
+                                        if line.strip()])
 
     # Columns that are not used:
     # - "auth" (e.g., "Logged In")
@@ -91,70 +271,100 @@ def process_log_file(cur, filepath: str):
     # Convert timestamp column to datetime
     t: pd.Series = pd.to_datetime(df['ts'], utc=True, unit='ms')
 
-    # Insert time data records
-    time_data = (t, t.dt.hour, t.dt.day, t.dt.weekofyear, t.dt.month,
-                 t.dt.year, t.dt.weekday)
-    column_labels = ('start_time', 'hour', 'day', 'week', 'month', 'year',
-                     'weekday')
-    time_df = pd.DataFrame(dict(zip(column_labels, time_data)))
+    # Time data records, one per distinct timestamp (each time unit is
+    # extracted once, as a NumPy array, and sent as an array parameter; start
+    # times are milliseconds since the Unix epoch)
+    unique_t = t.drop_duplicates()
+    weeks = unique_t.dt.isocalendar()['week'].to_numpy(dtype='int16')
+    time_data = (unique_t.values.view('int64') // 1_000_000,
+                 unique_t.dt.hour.to_numpy(), unique_t.dt.day.to_numpy(),
+                 weeks, unique_t.dt.month.to_numpy(),
+                 unique_t.dt.year.to_numpy(), unique_t.dt.weekday.to_numpy())
+
+    # User records (keep the last record of each user, so that the most
+    # recent "level" wins)
+    user_df = (df
+               .loc[:, ['userId', 'firstName', 'lastName', 'gender', 'level']]
+               .drop_duplicates(subset='userId', keep='last')
+               .astype({'userId': int}))
+
+    # Insert time and user records in a single round-trip
+    cur.execute(TIME_TABLE_INSERT_MANY + USER_TABLE_INSERT_MANY,
+                [column.tolist() for column in time_data] +
+                [user_df[column].tolist() for column in user_df])
+
+    # Insert songplay records (start times are nanoseconds since the Unix
+    # epoch, for the binary COPY)
+    start_times = t.values.view('int64')
+    song_ids = get_song_ids(cur, df)
+    songplay_data = []
+    rows = df.loc[:, ['song', 'artist', 'length', 'userId', 'level',
+                      'sessionId', 'location', 'userAgent']]
+    for start_time, (song, artist, length, user_id, level, session_id,
+                     location, user_agent) in zip(
+            start_times, rows.itertuples(index=False, name=None)):
 
-    for _, row in time_df.iterrows():
-        cur.execute(TIME_TABLE_INSERT, row)
+        # Get song_id and artist_id from song and artist tables
+        songid, artistid = song_ids.get((song, artist, length), (None, None))
 
-    # Load user table
-    user_df = df.loc[:, ['userId', 'firstName', 'lastName', 'gender', 'level']]
+        songplay_data.append((start_time, songid, artistid, user_id, level,
+                              session_id, location, user_agent))
 
-    # Insert user records
-    for _, row in user_df.iterrows():
-        cur.execute(USER_TABLE_INSERT, row)
+    copy_binary(cur, songplay_data,
+                ('timestamptz', 'text', 'text', 'int4', 'text', 'int4', 'text',
+                 'text'),
+                SONGPLAY_TABLE_COPY)
 
-    # Insert songplay records
-    for index, row in df.iterrows():
 
-        # Get song_id and artist_id from song and artist tables
-        cur.execute(SONG_SELECT, (row.song, row.artist, row.length))
-        results = cur.fetchone()
+def iter_files(filepath: str, suffix: str = '.json') -> Iterator[str]:
+    """
+    Iterate over all files ending with `suffix` in directory.
 
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
+    Parameters
+    ----------
+    filepath : str
+        Path with files possibly under sub-folders.
+    suffix : str, optional
+        End of the file names.
 
-        # Insert songplay record
-        songplay_data = ([t[index], songid, artistid] +
-                         row[['userId', 'level', 'sessionId', 'location',
-                              'userAgent']].values.tolist())
-        cur.execute(SONGPLAY_TABLE_INSERT, songplay_data)
+    Yields
+    ------
+    str
+        File name, prefixed with `filepath`.
+    """
+    with os.scandir(filepath) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path, suffix)
+            elif entry.name.endswith(suffix):
+                yield entry.path
 
 
-def get_files(filepath: str, pattern: str = '*.json') -> List[str]:
+def get_files(filepath: str, suffix: str = '.json') -> List[str]:
     """
-    Get all files matching pattern in directory.
+    Get all files ending with `suffix` in directory.
 
     Parameters
     ----------
     filepath : str
         Path with files possibly under sub-folders.
-    pattern : str, optional
-        Pattern to search in file names.
+    suffix : str, optional
+        End of the file names.
 
     Returns
     -------
     list[str]
         List of full file names.
     """
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root, pattern))
-        for f in files:
-            all_files.append(os.path.abspath(f))
-
-    return all_files
+    return list(iter_files(os.path.abspath(filepath), suffix))
 
 
-def process_data(cur: cursor, filepath: str, func: callable) -> None:
+def process_data(cur: cursor,
+                 filepath: str,
+                 func: callable,
+                 print_every: int = 100) -> None:
     """
-    Run `func` on all files under `filepath`.
+    Run `func` on all files under `filepath`, in one transaction per file.
 
     Parameters
     ----------
@@ -164,6 +374,8 @@ def process_data(cur: cursor, filepath: str, func: callable) -> None:
         Path with files possibly under sub-folders.
     func : callable
         Function.
+    print_every : int, optional
+        Print the progress every `print_every` files (and after the last one).
 
     Returns
     -------
@@ -178,19 +390,41 @@ def process_data(cur: cursor, filepath: str, func: callable) -> None:
     print('{:,d} files found in "{}"'.format(num_files, filepath))
 
     # Iterate over files and process
+    conn = cur.connection
     for i, datafile in enumerate(all_files, start=1):
-        func(cur, datafile)
-        print('{:03d}/{:03d} files processed'.format(i, num_files))
+        try:
+            func(cur, datafile)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if i % print_every == 0 or i == num_files:
+            print('{:03d}/{:03d} files processed'.format(i, num_files))
 
 
 def main():
     conn = psycopg2.connect(host=HOST, dbname=DBNAME, user=USER,
                             password=PASSWORD)
-    conn.set_session(autocommit=True)
     cur = conn.cursor()
 
-    process_data(cur, filepath='data/song_data', func=process_song_file)
-    process_data(cur, filepath='data/log_data', func=process_log_file)
+    execute_queries(cur, queries=BEFORE_LOAD_QUERIES)
+    conn.commit()
+
+    # Restore songplays (logged, with primary key and indexes) even if the
+    # load fails
+    try:
+        # The log files need all songs and artists to be loaded first
+        process_song_data(cur, filepath='data/song_data')
+        conn.commit()
+
+        # Song lookups are cached only while the songs and artists tables
+        # cannot change, i.e., during this log stage
+        _song_cache.clear()
+        process_data(cur, filepath='data/log_data', func=process_log_file)
+    finally:
+        conn.rollback()
+        execute_queries(cur, queries=AFTER_LOAD_QUERIES)
+        conn.commit()
 
     conn.close()
 
@@ -61,6 +61,8 @@ CREATE TABLE IF NOT EXISTS songplays (
 """
 
 # INSERT RECORDS
+# Single-row INSERT statements and SONG_SELECT (below) are not used by
+# `etl.py`; they are kept for `etl.ipynb`.
 
 SONG_TABLE_INSERT = """
 INSERT INTO songs (song_id, title, artist_id, year, duration)
@@ -92,6 +94,56 @@ INSERT INTO songplays (start_time, song_id, artist_id, user_id, level,
 VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
 """
 
+# INSERT MANY RECORDS
+# The song and artist INSERT statements take many rows at once with
+# `psycopg2.extras.execute_values`.
+
+SONG_TABLE_INSERT_MANY = """
+INSERT INTO songs (song_id, title, artist_id, year, duration)
+VALUES %s
+ON CONFLICT (song_id) DO NOTHING;
+"""
+
+ARTIST_TABLE_INSERT_MANY = """
+INSERT INTO artists (artist_id, name, location, latitude, longitude)
+VALUES %s
+ON CONFLICT (artist_id) DO NOTHING;
+"""
+
+# INSERT MANY RECORDS WITH ARRAYS
+# Each column is sent as an array parameter and expanded with UNNEST, so all
+# rows are inserted by a single statement, without a staging table.
+
+TIME_TABLE_INSERT_MANY = """
+INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+SELECT DISTINCT ON (ts)
+  TIMESTAMP WITH TIME ZONE 'epoch' + ts * INTERVAL '1 millisecond',
+  hour, day, week, month, year, weekday
+FROM UNNEST(%s::BIGINT[], %s::SMALLINT[], %s::SMALLINT[], %s::SMALLINT[],
+            %s::SMALLINT[], %s::SMALLINT[], %s::SMALLINT[])
+  AS t (ts, hour, day, week, month, year, weekday)
+ON CONFLICT (start_time) DO NOTHING;
+"""
+
+# The user IDs must be unique
+USER_TABLE_INSERT_MANY = """
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+SELECT user_id, first_name, last_name, gender, level
+FROM UNNEST(%s::INTEGER[], %s::VARCHAR[], %s::VARCHAR[], %s::CHAR(1)[],
+            %s::CHAR(4)[])
+  AS u (user_id, first_name, last_name, gender, level)
+ON CONFLICT (user_id) DO UPDATE SET level = EXCLUDED.level;
+"""
+
+# BULK LOAD (COPY FROM STDIN)
+# Songplays are streamed in PostgreSQL's binary COPY format.
+
+SONGPLAY_TABLE_COPY = """
+COPY songplays (start_time, song_id, artist_id, user_id, level, session_id,
+                location, user_agent)
+FROM STDIN WITH (FORMAT BINARY);
+"""
+
 # FIND SONGS
 
 SONG_SELECT = """
@@ -104,6 +156,23 @@ WHERE
   AND songs.duration = %s;
 """
 
+# Look up several (title, artist name, duration) triples at once with
+# `psycopg2.extras.execute_values`
+SONG_SELECT_MANY = """
+SELECT v.title, v.name, v.duration, songs.song_id, songs.artist_id
+FROM (VALUES %s) AS v (title, name, duration)
+INNER JOIN songs ON songs.title = v.title AND songs.duration = v.duration
+INNER JOIN artists ON artists.artist_id = songs.artist_id
+                  AND artists.name = v.name;
+"""
+SONG_SELECT_MANY_TEMPLATE = '(%s, %s, CAST(%s AS DOUBLE PRECISION))'
+
+# BULK LOAD SETUP
+# The songplays table has no WAL and no indexes while the ETL loads it; they
+# are restored after the load.
+
+songplay_index_columns = ('start_time', 'user_id', 'song_id', 'artist_id')
+
 # QUERY LISTS
 
 CREATE_TABLE_QUERIES = [song_table_create, artist_table_create,
@@ -111,3 +180,16 @@ CREATE_TABLE_QUERIES = [song_table_create, artist_table_create,
                         songplay_table_create]
 DROP_TABLE_QUERIES = [f'DROP TABLE IF EXISTS {table:s}'
                       for table in table_names]
+CREATE_INDEX_QUERIES = [f'CREATE INDEX IF NOT EXISTS songplays_{column:s}_idx '
+                        f'ON songplays ({column:s})'
+                        for column in songplay_index_columns]
+DROP_INDEX_QUERIES = [f'DROP INDEX IF EXISTS songplays_{column:s}_idx'
+                      for column in songplay_index_columns]
+BEFORE_LOAD_QUERIES = (['SET synchronous_commit = OFF',
+                        'ALTER TABLE songplays SET UNLOGGED',
+                        'ALTER TABLE songplays '
+                        'DROP CONSTRAINT IF EXISTS songplays_pkey'] +
+                       DROP_INDEX_QUERIES)
+AFTER_LOAD_QUERIES = (['ALTER TABLE songplays SET LOGGED',
+                       'ALTER TABLE songplays ADD PRIMARY KEY (songplay_id)'] +
+                      CREATE_INDEX_QUERIES)